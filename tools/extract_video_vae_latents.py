@@ -10,23 +10,62 @@ sys.path.append(str(project_root))
 
 
 import cv2, torch, jsonlines, argparse
+import asyncio
+import functools
+import threading
+import numpy as np
 from tqdm import tqdm
 from concurrent import futures
-from torchvision import transforms as pth_transforms
+from torchvision.transforms import v2 as transforms_v2
 from torchvision.transforms.functional import InterpolationMode
 from torch.utils.data import Dataset, DistributedSampler, DataLoader
 
 from video_vae.causal_video_vae_wrapper import CausalVideoVAELossWrapper
 from trainer_misc import init_distributed_mode
 
-
-
+try:
+    # The optional NVDEC decoding backend, decode H.264/HEVC directly into cuda tensors
+    from torchcodec.decoders import VideoDecoder
+except ImportError:
+    VideoDecoder = None
+
+try:
+    # The optional decord backend, batched random-access decode (NVDEC with a gpu ctx)
+    import decord
+except ImportError:
+    decord = None
+
+try:
+    # The optional PyAV backend, used to seek when the frame indexs are sparse
+    import av
+except ImportError:
+    av = None
+
+try:
+    # safetensors serialization is a plain memcpy to the page cache, no pickle/zip under the GIL
+    from safetensors.torch import save_file as safetensors_save_file
+    from safetensors.torch import save as safetensors_save_bytes
+except ImportError:
+    safetensors_save_file = None
+    safetensors_save_bytes = None
+
+try:
+    # optional async s3 client, lets the latents stream straight to object storage
+    from aiobotocore.session import get_session as get_aiobotocore_session
+except ImportError:
+    get_aiobotocore_session = None
+
+
+
+# the source shapes cluster into a few discrete sizes, so the compose is built once
+# per (width, height) key instead of being re-instantiated for every sample
+@functools.lru_cache(maxsize=64)
 def get_transform(width,
                   height,
                   new_width=None,
                   new_height=None,
                   resize=False,):
-    
+
     transform_list = []
 
     if resize:
@@ -38,75 +77,321 @@ def get_transform(width,
         resized_width = round(width * scale)
         resized_height = round(height * scale)
 
-        transform_list.append(pth_transforms.Resize(size=(resized_height, resized_width), 
-                                                    interpolation=InterpolationMode.BICUBIC,
-                                                    antialias=True))
-        
-        transform_list.append(pth_transforms.CenterCrop(size=(new_height, new_width)))
+        transform_list.append(transforms_v2.Resize(size=(resized_height, resized_width),
+                                                   interpolation=InterpolationMode.BICUBIC,
+                                                   antialias=True))
+
+        transform_list.append(transforms_v2.CenterCrop(size=(new_height, new_width)))
 
 
-    transform_list.extend([
-        pth_transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-    ])
-    transform_list = pth_transforms.Compose(transform_list)
+    if len(transform_list) == 0:
+        transform_list.append(transforms_v2.Identity())
+
+    # only the geometric ops stay here and run on uint8, the uint8 -> float cast and
+    # the normalize are fused into a single elementwise pass by the caller
+    transform_list = transforms_v2.Compose(transform_list)
 
     return transform_list
 
 
 
+def transform_on_device(frames, new_width, new_height):
+
+    # The same Resize + CenterCrop + Normalize as get_transform, applied on the gpu:
+    # bicubic resize on the device is far cheaper than torchvision cpu bicubic in the workers
+    if frames.dim() == 4:
+        frames = frames.unsqueeze(0)    # (T, 3, H, W) -> (1, T, 3, H, W)
+
+    batch, length = frames.shape[0], frames.shape[1]
+    frames = frames.float().flatten(0, 1)
+
+    height, width = frames.shape[-2], frames.shape[-1]
+    scale = max(new_width / width, new_height / height)
+    resized_width = round(width * scale)
+    resized_height = round(height * scale)
+
+    frames = torch.nn.functional.interpolate(frames, size=(resized_height, resized_width),
+                                             mode='bicubic', antialias=True)
+
+    top = int(round((resized_height - new_height) / 2.0))
+    left = int(round((resized_width - new_width) / 2.0))
+    frames = frames[..., top:top + new_height, left:left + new_width]
+
+    # fused (x / 255 - 0.5) / 0.5 in one in-place pass
+    frames = frames.mul_(1.0 / 127.5).sub_(1.0)
+
+    frames = frames.unflatten(0, (batch, length))
+
+    return frames.permute(0, 2, 1, 3, 4)    # (B, 3, T, H', W')
+
+
+
+def load_video_gpu_decode(video_path,
+                          frame_indexs,
+                          frame_number,
+                          device='cuda'):
+
+    # Decode with NVDEC, the frames are written directly into a (T, 3, H, W) uint8 cuda tensor,
+    # skipping the cpu color conversion and the host-to-device copy
+    if VideoDecoder is not None:
+        decoder = VideoDecoder(video_path, device=device)
+        num_frames = decoder.metadata.num_frames
+        frame_indexs = [frame_index for frame_index in frame_indexs if frame_index < num_frames]
+
+        if len(frame_indexs) == 0:
+            print(f"Empty video {video_path}")
+
+            return None
+
+        frames = decoder.get_frames_at(indices=frame_indexs).data
+
+    else:
+        # decord NVDEC path, used when torchcodec is not installed
+        decord.bridge.set_bridge('torch')
+        device_index = int(device.split(':')[-1]) if ':' in device else 0
+        video_reader = decord.VideoReader(video_path, ctx=decord.gpu(device_index))
+
+        num_frames = len(video_reader)
+        frame_indexs = [frame_index for frame_index in frame_indexs if frame_index < num_frames]
+
+        if len(frame_indexs) == 0:
+            print(f"Empty video {video_path}")
+
+            return None
+
+        frames = video_reader.get_batch(frame_indexs).permute(0, 3, 1, 2)
+
+    frames = frames[:frame_number]
+    duration = ((frames.shape[0] - 1) // 8) * 8 + 1      # make sure the frames match: f * 8 + 1
+    frames = frames[:duration]
+
+    return frames
+
+
+
+def group_contiguous_indexs(frame_indexs):
+
+    # split the sorted frame indexs into contiguous groups, one seek per group
+    groups = [[frame_indexs[0]]]
+
+    for frame_index in frame_indexs[1:]:
+        if frame_index == groups[-1][-1] + 1:
+            groups[-1].append(frame_index)
+        else:
+            groups.append([frame_index])
+
+    return groups
+
+
+
+def load_video_decord_decode(video_path,
+                             frame_indexs):
+
+    # decord seeks internally and returns exactly the requested indices in one batch,
+    # no per-frame python roundtrip and no bgr conversion
+    decord.bridge.set_bridge('native')
+    video_reader = decord.VideoReader(video_path, ctx=decord.cpu(0))
+
+    num_frames = len(video_reader)
+    frame_indexs = [frame_index for frame_index in frame_indexs if frame_index < num_frames]
+
+    if len(frame_indexs) == 0:
+        return None
+
+    return video_reader.get_batch(frame_indexs).asnumpy()    # (T, H, W, 3) uint8 rgb
+
+
+
+def load_video_seek_decode(video_path,
+                           frame_indexs):
+
+    # Seek to the nearest prior keyframe for each contiguous index group and only
+    # decode the needed GOPs, instead of decoding every frame from 0 to frame_indexs[-1]
+    frames = []
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        rate = stream.average_rate
+        time_base = stream.time_base
+
+        for group in group_contiguous_indexs(frame_indexs):
+            pts = int(group[0] / rate / time_base)
+            container.seek(pts, any_frame=False, backward=True, stream=stream)
+            wanted = set(group)
+
+            for frame in container.decode(stream):
+                frame_index = int(round(frame.pts * time_base * rate))
+
+                if frame_index in wanted:
+                    frames.append(frame.to_rgb().to_ndarray())    # (H, W, 3) uint8 rgb
+
+                if frame_index >= group[-1]:
+                    break
+
+    if len(frames) == 0:
+        return None
+
+    return np.stack(frames)
+
+
+
 def load_video_and_transform(video_path,
                              frame_indexs,
                              frame_number,
                              new_width=None,
                              new_height=None,
-                             resize=False):
-    
-    video_capture = None 
-    frame_indexes_set = set(frame_indexs)
-
-    try:
-        
-        video_capture = cv2.VideoCapture(video_path)
-        frames = []
-        frame_index = 0 
+                             resize=False,
+                             gpu_decode_device=None,
+                             apply_transform=True):
 
-        while True:
-            flag, frame = video_capture.read()
-            if not flag:
-                break
+    video_capture = None
+    frame_indexes_set = set(frame_indexs)
+    # dense-from-zero requests keep the cheap sequential decode, seeking only pays off for sparse indexs
+    sparse_indexs = frame_indexs != list(range(frame_indexs[-1] + 1))
 
-            if frame_index > frame_indexs[-1]:
-                break
+    if gpu_decode_device is not None and (VideoDecoder is not None or decord is not None):
+        try:
+            return load_video_gpu_decode(video_path=video_path,
+                                         frame_indexs=frame_indexs,
+                                         frame_number=frame_number,
+                                         device=gpu_decode_device)
 
-            if frame_index in frame_indexes_set:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame = torch.from_numpy(frame)
-                frame = frame.permute(2, 0, 1)
-                frames.append(frame)
+        except Exception as e:
+            print(f"NVDEC decoding video: {video_path} exception {e}, fallback to cpu decoding")
 
-            frame_index += 1 
-        video_capture.release()
+    try:
 
-        if len(frames) == 0:
+        frames = None
+        decoded = False
+
+        # a decord/PyAV failure (narrower codec coverage than the cv2 FFmpeg build)
+        # must fall through to the cv2 loop instead of dropping the video
+        if decord is not None:
+            try:
+                frames = load_video_decord_decode(video_path=video_path,
+                                                  frame_indexs=frame_indexs)
+                decoded = True
+            except Exception as e:
+                print(f"decord decoding video: {video_path} exception {e}, fallback to cv2")
+
+        if not decoded and sparse_indexs and av is not None:
+            try:
+                frames = load_video_seek_decode(video_path=video_path,
+                                                frame_indexs=frame_indexs)
+                decoded = True
+            except Exception as e:
+                print(f"PyAV decoding video: {video_path} exception {e}, fallback to cv2")
+
+        if not decoded:
+            video_capture = cv2.VideoCapture(video_path)
+            frames_buffer = None
+            filled = 0
+            frame_index = 0
+            last_index = frame_indexs[-1]
+
+            if len(frame_indexes_set) >= 0.5 * (last_index + 1):
+                # dense request: decode everything up to the last index with a single
+                # comparison per frame, then gather the wanted rows in one vectorized
+                # fancy-index instead of two python branches per decoded frame
+                raw_buffer = None
+                decoded_count = 0
+
+                while decoded_count <= last_index:
+                    if raw_buffer is None:
+                        flag, frame = video_capture.read()
+                        if not flag:
+                            break
+
+                        raw_buffer = np.empty((last_index + 1,) + frame.shape, dtype=np.uint8)
+                        raw_buffer[0] = frame
+
+                    else:
+                        flag, frame = video_capture.read(raw_buffer[decoded_count])
+                        if not flag:
+                            break
+
+                        if not np.shares_memory(frame, raw_buffer):
+                            raw_buffer[decoded_count] = frame
+
+                    decoded_count += 1
+                video_capture.release()
+
+                if decoded_count > 0:
+                    wanted = np.asarray([frame_index for frame_index in frame_indexs
+                                         if frame_index < decoded_count], dtype=np.int64)
+                    frames_buffer = raw_buffer[wanted]
+                    filled = len(wanted)
+
+                # bgr -> rgb with a stride flip, no per-frame cvtColor
+                frames = frames_buffer[:, :, :, ::-1] if filled > 0 else None
+
+            else:
+                while frame_index <= last_index:
+                    if frame_index not in frame_indexes_set:
+                        # grab decodes without retrieving, skipping the bgr convert and the copy out
+                        if not video_capture.grab():
+                            break
+                        frame_index += 1
+                        continue
+
+                    if frames_buffer is None:
+                        flag, frame = video_capture.read()
+                        if not flag:
+                            break
+
+                        # accumulate the raw bgr frames into one preallocated buffer
+                        frames_buffer = np.empty((len(frame_indexs),) + frame.shape, dtype=np.uint8)
+                        frames_buffer[filled] = frame
+
+                    else:
+                        # decode straight into the preallocated row, no intermediate frame allocation
+                        flag, frame = video_capture.read(frames_buffer[filled])
+                        if not flag:
+                            break
+
+                        if not np.shares_memory(frame, frames_buffer):
+                            frames_buffer[filled] = frame
+
+                    filled += 1
+                    frame_index += 1
+                video_capture.release()
+
+                # bgr -> rgb with a stride flip, no per-frame cvtColor
+                frames = frames_buffer[:filled, :, :, ::-1] if filled > 0 else None
+
+        if frames is None or len(frames) == 0:
             print(f"Empty video {video_path}")
 
-            return None 
-        
+            return None
+
 
         frames = frames[:frame_number]
-        duration = ((len(frames) -1) // 8) * 8 + 1      # make sure the frames match: f * 8 + 1 
+        duration = ((len(frames) -1) // 8) * 8 + 1      # make sure the frames match: f * 8 + 1
         frames = frames[:duration]
-        frames = torch.stack(frames).float() / 255 
+
+        # one bulk contiguous copy instead of T small per-frame conversions
+        frames = torch.from_numpy(np.ascontiguousarray(frames)).permute(0, 3, 1, 2)
+
+        if not apply_transform:
+            # keep the frames as uint8, the transform runs on the gpu in the main process
+            return frames
+
+        # the permuted decode buffer is already channels_last in memory, which is what
+        # the fast uint8 resize path wants; the transform gets raw uint8, not float
+        frames = frames.contiguous(memory_format=torch.channels_last)
 
         video_transform = get_transform(width=frames.shape[-1],
                                         height=frames.shape[-2],
                                         new_width=new_width,
                                         new_height=new_height,
                                         resize=resize)
-        
-        frames = video_transform(frames).permute(1, 0, 2, 3)
 
-        return frames
+        # the resize runs on uint8 and shrinks the frames first, then a single fused
+        # cast + normalize pass, instead of materializing two full float32 copies
+        frames = video_transform(frames)
+        frames = frames.to(torch.float32).mul_(1.0 / 127.5).sub_(1.0)
+
+        return frames.permute(1, 0, 2, 3)
     
 
     except Exception as e:
@@ -124,35 +409,104 @@ class VideoDataset(Dataset):
                  anno_file,
                  width,
                  height,
-                 num_frames):
-        
+                 num_frames,
+                 gpu_decode_device=None,
+                 cpu_transform=False,
+                 force=False):
+
 
         super().__init__()
-        self.annotation = []
         self.width = width
         self.height = height
         self.num_frames = num_frames
+        self.gpu_decode_device = gpu_decode_device
+        self.cpu_transform = cpu_transform
+
+        # columnar layout instead of a list of dicts: two parallel path lists plus a
+        # csr-style (offsets, values) pair for the optional per-item frame indexs,
+        # much lighter than millions of small dicts and cheaper to fork to the workers
+        video_paths = []
+        latent_paths = []
+        frames_offsets = [0]
+        frames_values = []
 
         with jsonlines.open(anno_file, 'r') as reader:
             for item in tqdm(reader):
-                self.annotation.append(item)
+                video_paths.append(item['video'])
+                latent_paths.append(item['latent'])
 
-        tot_len = len(self.annotation)
-        print(f"Totally {len(self.annotation)} videos")
+                if 'frames' in item:
+                    frames_values.extend(item['frames'])
+                frames_offsets.append(len(frames_values))
 
+        if not force:
+            # resumable runs: drop the items whose latent is already on disk, the
+            # exists checks are io bound so fan them out on a thread pool
+            with futures.ThreadPoolExecutor(max_workers=32) as executor:
+                exists = list(executor.map(os.path.exists, latent_paths))
 
-    def process_one_video(self,
-                          video_item):
-        
-        video_per_task = []
-        video_path = video_item['video']
-        output_latent_path = video_item['latent']
+            if any(exists):
+                kept = [i for i, done in enumerate(exists) if not done]
+                print(f"Skip {len(latent_paths) - len(kept)} videos with existing latents")
+
+                video_paths = [video_paths[i] for i in kept]
+                latent_paths = [latent_paths[i] for i in kept]
+
+                kept_offsets = [0]
+                kept_values = []
+                for i in kept:
+                    kept_values.extend(frames_values[frames_offsets[i]:frames_offsets[i + 1]])
+                    kept_offsets.append(len(kept_values))
+                frames_offsets, frames_values = kept_offsets, kept_values
+
+        # pack everything into shared-memory tensors, all the workers then map the
+        # same physical pages instead of each holding a copy of the manifest
+        self.video_paths_blob, self.video_paths_offsets = self._pack_strings(video_paths)
+        self.latent_paths_blob, self.latent_paths_offsets = self._pack_strings(latent_paths)
+
+        self.frames_offsets = torch.from_numpy(np.asarray(frames_offsets, dtype=np.int64)).share_memory_()
+        self.frames_values = torch.from_numpy(np.asarray(frames_values, dtype=np.int32)).share_memory_()
+
+        print(f"Totally {len(video_paths)} videos")
+
+
+    @staticmethod
+    def _pack_strings(strings):
+
+        # concatenated utf-8 blob + int64 offsets, both living in shared memory
+        offsets = [0]
+        chunks = []
+
+        for string in strings:
+            chunks.append(string.encode('utf-8'))
+            offsets.append(offsets[-1] + len(chunks[-1]))
+
+        blob = b''.join(chunks)
+        if len(blob) > 0:
+            blob = torch.frombuffer(bytearray(blob), dtype=torch.uint8)
+        else:
+            blob = torch.empty(0, dtype=torch.uint8)
+
+        offsets = torch.from_numpy(np.asarray(offsets, dtype=np.int64))
+
+        return blob.share_memory_(), offsets.share_memory_()
+
+
+    @staticmethod
+    def _unpack_string(blob, offsets, index):
 
+        start, end = offsets[index].item(), offsets[index + 1].item()
 
-        # The sampled frame indexs of a video, if not specified, load frames: [0, num_frames]
-        frame_indexs = video_item['frames'] if 'frames' in video_item else list(range(self.num_frames))
+        return blob[start:end].numpy().tobytes().decode('utf-8')
 
 
+    def process_one_video(self,
+                          video_path,
+                          output_latent_path,
+                          frame_indexs):
+
+        video_per_task = []
+
         try:
             video_frames_tensors = load_video_and_transform(
                 video_path=video_path,
@@ -160,13 +514,16 @@ class VideoDataset(Dataset):
                 frame_number=self.num_frames,   # The number of frames to encode 
                 new_width=self.width,
                 new_height=self.height,
-                resize=True
+                resize=True,
+                gpu_decode_device=self.gpu_decode_device,
+                apply_transform=self.cpu_transform
             )
 
             if video_frames_tensors is None:
                 return video_per_task
-            
-            video_frames_tensors = video_frames_tensors.unsqueeze(0)
+
+            if self.cpu_transform:
+                video_frames_tensors = video_frames_tensors.unsqueeze(0)
             video_per_task.append({'video': video_path,
                                    'input': video_frames_tensors,
                                    'output': output_latent_path})
@@ -184,18 +541,29 @@ class VideoDataset(Dataset):
     def __getitem__(self, index):
 
         try:
-            video_item = self.annotation[index]
-            video_per_task = self.process_one_video(video_item)
+            # The sampled frame indexs of a video, if not specified, load frames: [0, num_frames]
+            start, end = self.frames_offsets[index].item(), self.frames_offsets[index + 1].item()
+            if end > start:
+                frame_indexs = self.frames_values[start:end].tolist()
+            else:
+                frame_indexs = list(range(self.num_frames))
+
+            video_path = self._unpack_string(self.video_paths_blob, self.video_paths_offsets, index)
+            latent_path = self._unpack_string(self.latent_paths_blob, self.latent_paths_offsets, index)
+
+            video_per_task = self.process_one_video(video_path=video_path,
+                                                    output_latent_path=latent_path,
+                                                    frame_indexs=frame_indexs)
 
         except Exception as e:
             print(f"Error with {e}")
             video_per_task = []
 
         return video_per_task
-    
+
 
     def __len__(self):
-        return len(self.annotation)
+        return self.video_paths_offsets.numel() - 1
     
 
 
@@ -211,6 +579,11 @@ def get_args():
     parser.add_argument("--height", type=int, default=384, help="The video height")
     parser.add_argument("--num_frames", type=int, default=121, help="The frame number to encode")
     parser.add_argument("--save_memory", action="store_true", help="Open the VAE tilling")
+    parser.add_argument("--gpu_decode", action="store_true", help="Decode the video with NVDEC, needs torchcodec")
+    parser.add_argument("--cpu_transform", action="store_true", help="Keep the transform in the dataloader workers")
+    parser.add_argument("--force", action="store_true", help="Re-extract even if the latent file already exists")
+    parser.add_argument("--quant", default="none", type=str, choices=["none", "int8", "fp8"],
+                        help="Quantize the VAE encoder weights with torchao, fp8 needs hopper-class gpus")
     return parser.parse_args()
 
 
@@ -226,60 +599,232 @@ def build_model(args):
                                       add_discriminator=False)
     model = model.eval()
 
-    return model 
+    if getattr(args, 'quant', 'none') != 'none':
+        # extraction is inference only, quantize the encoder weights to cut the weight
+        # bandwidth into the SMs; the decoder is left untouched since it never runs here
+        from torchao.quantization import (quantize_,
+                                          int8_weight_only,
+                                          float8_dynamic_activation_float8_weight)
 
+        if args.quant == 'int8':
+            quantize_(model.vae.encoder, int8_weight_only())
+        else:
+            quantize_(model.vae.encoder, float8_dynamic_activation_float8_weight())
 
+    return model
 
-def build_data_loader(args):
 
-    def collate_fn(batch):
 
-        return_batch = {'input': [],
-                        'output': []}
-        
+# module level so the forkserver workers can pickle it, a function nested in
+# build_data_loader would fail to import on worker startup
+def collate_fn(batch):
 
-        for videos_ in batch:
-            for video_input in videos_:
-                return_batch['input'].append(video_input['input'])
-                return_batch['output'].append(video_input['output'])
+    return_batch = {'input': [],
+                    'output': []}
 
-        return return_batch
-    
+
+    for videos_ in batch:
+        for video_input in videos_:
+            return_batch['input'].append(video_input['input'])
+            return_batch['output'].append(video_input['output'])
+
+    return return_batch
+
+
+
+def build_data_loader(args):
+
+    gpu_decode = args.gpu_decode and (VideoDecoder is not None or decord is not None)
+
+    if args.gpu_decode and not gpu_decode:
+        print("neither torchcodec nor decord is installed, fallback to cpu decoding")
 
     dataset = VideoDataset(anno_file=args.anno_file,
                            width=args.width,
                            height=args.height,
-                           num_frames=args.num_frames)
-    
+                           num_frames=args.num_frames,
+                           gpu_decode_device=f"cuda:{args.gpu}" if gpu_decode else None,
+                           cpu_transform=args.cpu_transform,
+                           force=args.force)
+
     sampler = DistributedSampler(dataset=dataset,
                                  num_replicas=args.world_size,
                                  rank=args.rank,
                                  shuffle=False)
-    
+
+    # NVDEC decoding produces cuda tensors, it runs in the main process, no workers and no pinning
+    num_workers = 0 if gpu_decode else 6
+
+    # clamp the prefetch depth so the queued frame buffers cannot eat more than half
+    # the host ram, the raw decode resolution is unknown up front so assume 1080p
+    batch_bytes = args.batch_size * args.num_frames * 3 * 1920 * 1080
+    total_ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    prefetch_factor = 4
+    while prefetch_factor > 2 and num_workers * prefetch_factor * batch_bytes > 0.5 * total_ram:
+        prefetch_factor -= 1
+
     loader = DataLoader(
         dataset=dataset,
         batch_size=args.batch_size,
-        num_workers=6,
-        pin_memory=True,
+        num_workers=num_workers,
+        pin_memory=not gpu_decode,
         sampler=sampler,
         shuffle=False,
         collate_fn=collate_fn,
         drop_last=False,
-        prefetch_factor=2
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        # keep the workers alive across epochs and avoid forking the full parent heap
+        persistent_workers=num_workers > 0,
+        multiprocessing_context='forkserver' if num_workers > 0 else None
     )
 
     return loader
 
 
 
-def save_tensor(tensor, 
-                output_path):
-    
+class AsyncS3Uploader:
+    """Background asyncio loop streaming latent bytes to s3 with bounded concurrency."""
+
+    def __init__(self, max_concurrency=32):
+
+        self.max_concurrency = max_concurrency
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._client = None
+
+        # the lock and the semaphore are created once, on the loop thread; the client
+        # itself stays lazy so runs that never touch s3 do not need credentials
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+
+
+    async def _setup(self):
+        self._init_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+
+    async def _put(self, data, bucket, key):
+
+        # concurrent first puts must not each open (and leak) their own client
+        async with self._init_lock:
+            if self._client is None:
+                session = get_aiobotocore_session()
+                self._client = await session.create_client('s3').__aenter__()
+
+        async with self._semaphore:
+            await self._client.put_object(Bucket=bucket, Key=key, Body=data)
+
+
+    def submit(self, data, output_path):
+
+        bucket, key = output_path[len('s3://'):].split('/', 1)
+
+        return asyncio.run_coroutine_threadsafe(self._put(data, bucket, key), self._loop)
+
+
+    def close(self):
+
+        async def _close_client():
+            if self._client is not None:
+                await self._client.__aexit__(None, None, None)
+
+        asyncio.run_coroutine_threadsafe(_close_client(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+
+class PinnedBufferRing:
+    """Round-robin pool of pinned cpu tensors backing the async h2d/d2h copies."""
+
+    def __init__(self, num_slots=8):
+
+        self.num_slots = num_slots
+        self.slots = [None] * num_slots
+        self.pending = [None] * num_slots
+        self.next_slot = 0
+
+
+    def acquire(self, shape, dtype):
+
+        slot_index = self.next_slot
+        self.next_slot = (slot_index + 1) % self.num_slots
+
+        if self.pending[slot_index] is not None:
+            # a slot is only recycled after everything reading it has finished,
+            # saver futures on the d2h side and copy events on the h2d side
+            for item in self.pending[slot_index]:
+                if isinstance(item, torch.cuda.Event):
+                    item.synchronize()
+                else:
+                    item.result()
+            self.pending[slot_index] = None
+
+        numel = 1
+        for size in shape:
+            numel *= size
+
+        slot = self.slots[slot_index]
+        if slot is None or slot.numel() < numel or slot.dtype != dtype:
+            # pinned memory keeps the copy truly asynchronous
+            slot = torch.empty(numel, dtype=dtype, pin_memory=True)
+            self.slots[slot_index] = slot
+
+        return slot_index, slot[:numel].view(shape)
+
+
+    def attach(self, slot_index, slot_pending):
+        self.pending[slot_index] = slot_pending
+
+
+
+def save_tensor(tensor,
+                output_path,
+                d2h_event=None,
+                uploader=None):
+
     try:
-        torch.save(tensor.clone(), output_path)
+        if d2h_event is not None:
+            # make sure the async device-to-host copy has landed before touching the tensor
+            d2h_event.synchronize()
+
+        if uploader is not None and output_path.startswith('s3://'):
+            # serialize to bytes here and stream to the object store, no local fs round-trip
+            data = safetensors_save_bytes({"latent": tensor.contiguous()})
+            uploader.submit(data, output_path).result()
+
+        elif safetensors_save_file is not None:
+            safetensors_save_file({"latent": tensor.contiguous()}, output_path)
+        else:
+            # clone so a batch-split view does not serialize the whole batch storage
+            torch.save(tensor.clone(), output_path)
 
     except Exception as e:
-        pass 
+        print(f"Saving latent to {output_path} exception {e}")
+
+
+
+def iter_video_groups(data_loader):
+
+    # flatten the dataloader batches and group consecutive same-shape videos,
+    # each group encodes as one batched call instead of batch-1 forwards
+    for sample in tqdm(data_loader):
+        group_inputs, group_paths = [], []
+
+        for video_input, output_path in zip(sample['input'], sample['output']):
+            # the device matters too: a failed NVDEC decode falls back to a cpu tensor
+            # and must not be stacked with its cuda neighbors
+            if group_inputs and (video_input.shape != group_inputs[0].shape
+                                 or video_input.dtype != group_inputs[0].dtype
+                                 or video_input.device != group_inputs[0].device):
+                yield group_inputs, group_paths
+                group_inputs, group_paths = [], []
+
+            group_inputs.append(video_input)
+            group_paths.append(output_path)
+
+        if group_inputs:
+            yield group_inputs, group_paths
 
 
 
@@ -295,6 +840,18 @@ def main():
     model = build_model(args)
     model.to(device)
 
+    # every sample shares the same post-transform shape, so the cudnn autotune cost
+    # is paid once and the encode can be compiled for the stable shapes
+    torch.backends.cudnn.benchmark = True
+    try:
+        # compile errors only surface at the first call, not at wrap time, so tell
+        # dynamo to fall back to eager on failure instead of aborting the run; this
+        # also covers the device_transform wrap below
+        torch._dynamo.config.suppress_errors = True
+        model.encode_latent = torch.compile(model.encode_latent, dynamic=False)
+    except Exception as e:
+        print(f"torch.compile encode_latent failed: {e}, keep the eager path")
+
     if args.model_dtype == "bf16":
         torch_dtype = torch.bfloat16
     elif args.model_dtype == "fp16":
@@ -313,33 +870,131 @@ def main():
 
 
     if args.save_memory:
-        # open the tiling, to reduce gpu memory cost 
+        # open the tiling, to reduce gpu memory cost
         model.vae.enable_tiling()
 
+    # announce the on-disk format once, the two serializers write to the same manifest
+    # paths and must not be mixed across resumed runs of one dataset
+    if safetensors_save_file is not None:
+        print("Saving the latents in safetensors format")
+    else:
+        print("safetensors is not installed, saving the latents with torch.save (pickle format)")
+
+    # side streams: overlap the next sample's h2d copy and the latent d2h copy with the encode
+    copy_stream = torch.cuda.Stream()
+    d2h_stream = torch.cuda.Stream()
+    pinned_ring = PinnedBufferRing(num_slots=8)
+    h2d_ring = PinnedBufferRing(num_slots=4)
+
+    # s3:// latent paths stream to object storage, the client is only opened on first use
+    uploader = None
+    if get_aiobotocore_session is not None and safetensors_save_bytes is not None:
+        uploader = AsyncS3Uploader()
+
+    # fuse the resize/crop/normalize chain, the shapes are stable so each key compiles once
+    device_transform = transform_on_device
+    try:
+        device_transform = torch.compile(transform_on_device, dynamic=False)
+    except Exception as e:
+        print(f"torch.compile the device transform failed: {e}, keep the eager path")
+
+
+    def stage_h2d(video_inputs, output_paths):
+        # batch the group so it moves as one copy and encodes as one batch; a single
+        # cpu video is forwarded as a view, keeping the dataloader's pinning intact
+        slot_index = None
+        first = video_inputs[0]
+
+        if len(video_inputs) == 1:
+            batched = first.unsqueeze(0) if first.dim() == 4 else first
+        elif first.is_cuda:
+            # NVDEC-decoded group, the stack happens on the device
+            batched = torch.stack(video_inputs) if first.dim() == 4 else torch.cat(video_inputs, dim=0)
+        else:
+            # stack/cat would allocate a pageable host tensor and turn the h2d copy
+            # synchronous, stage the group through a pinned slot instead
+            one_shape = tuple(first.shape) if first.dim() == 4 else tuple(first.shape[1:])
+            slot_index, batched = h2d_ring.acquire((len(video_inputs),) + one_shape, first.dtype)
+
+            for row, video_input in zip(batched, video_inputs):
+                row.copy_(video_input if video_input.dim() == 4 else video_input[0])
+
+        # launch the host-to-device copy on the copy stream, it runs under the current encode
+        with torch.cuda.stream(copy_stream):
+            batched = batched.to(device, non_blocking=True)
+            h2d_event = torch.cuda.Event()
+            h2d_event.record(copy_stream)
+
+        if slot_index is not None:
+            # the pinned slot is free once the copy to the device has completed
+            h2d_ring.attach(slot_index, [h2d_event])
+
+        return batched, h2d_event, output_paths
+
+
     with futures.ThreadPoolExecutor(max_workers=16) as executor:
 
-        for sample in tqdm(data_loader):
-            input_video_list = sample['input']
-            output_path_list = sample['output']
+        video_iter = iter_video_groups(data_loader)
+        staged = next(video_iter, None)
+        if staged is not None:
+            staged = stage_h2d(*staged)
+
+        while staged is not None:
+            video_input, h2d_event, output_paths = staged
+
+            # prefetch the next sample's copy before this one computes
+            next_item = next(video_iter, None)
+            staged = stage_h2d(*next_item) if next_item is not None else None
+
+            torch.cuda.current_stream().wait_event(h2d_event)
+            video_input.record_stream(torch.cuda.current_stream())
 
             with torch.no_grad(), torch.autocast(device_type="cuda",
-                                                 enabled=True, 
+                                                 enabled=True,
                                                  dtype=torch_dtype):
-                for video_input, output_path in zip(input_video_list, output_path_list):
 
-                    video_latent = model.encode_latent(video_input.to(device), 
-                                                       sample=True,
-                                                       window_size=window_size,
-                                                       temporal_chunk=temporal_chunk,
-                                                       tile_sample_min_size=256)
-                    video_latent = video_latent.to(torch_dtype).cpu()
+                if video_input.dtype == torch.uint8:
+                    # the workers only decode, run Resize + CenterCrop + Normalize here on the gpu
+                    video_input = device_transform(video_input,
+                                                   new_width=args.width,
+                                                   new_height=args.height)
+
+                video_latent = model.encode_latent(video_input,
+                                                   sample=True,
+                                                   window_size=window_size,
+                                                   temporal_chunk=temporal_chunk,
+                                                   tile_sample_min_size=256)
+
+            # downcast on the device before the d2h copy, so the transfer (and the cpu
+            # buffer) moves half the bytes when saving in bf16/fp16
+            video_latent = video_latent.to(torch_dtype)
+
+            # copy the latent back on its own stream so the next encode is not flushed,
+            # into a recycled pinned slot so the copy is actually asynchronous
+            d2h_stream.wait_stream(torch.cuda.current_stream())
+            slot_index, latent_cpu = pinned_ring.acquire(video_latent.shape, video_latent.dtype)
+            with torch.cuda.stream(d2h_stream):
+                latent_cpu.copy_(video_latent, non_blocking=True)
+                d2h_event = torch.cuda.Event()
+                d2h_event.record(d2h_stream)
+            video_latent.record_stream(d2h_stream)
+
+            # hand one latent per video to the saver threads, split along the batch dim
+            slot_futures = []
+            for latent_one, output_path in zip(latent_cpu.split(1, dim=0), output_paths):
+                slot_futures.append(executor.submit(save_tensor, latent_one, output_path,
+                                                    d2h_event, uploader))
+
+            pinned_ring.attach(slot_index, slot_futures)
+            task_queue.extend(slot_futures)
 
-                    task_queue.append(executor.submit(save_tensor, video_latent, output_path))
 
-                
         for future in futures.as_completed(task_queue):
             res = future.result()
 
+    if uploader is not None:
+        uploader.close()
+
     torch.distributed.barrier()
 
 